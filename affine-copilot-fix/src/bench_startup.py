@@ -0,0 +1,144 @@
+"""
+Startup benchmark for the gateway.
+
+Each run starts a fresh interpreter, imports `endpoint` and serves requests
+through Flask's test client, so the numbers reflect a container cold start.
+The default provider is pointed at a local stub upstream (an http.server
+thread in this process), so no real backend or network is involved:
+
+  import_ms         time to import endpoint.py (config + Flask app setup)
+  first_request_ms  time from import done to the first /health response
+  first_chat_ms     time for the first /responses call after that: includes
+                    the deferred openai import and client construction, i.e.
+                    what AFFiNE's first call pays before warm-up has finished
+                    (or with WARMUP=false)
+  ready_ms          (with --ready) time until /ready turns 200, i.e. every
+                    configured provider validated and its pool warmed
+  openai_loaded     whether the openai SDK was pulled in by the import
+                    (it should not be; it is deferred to first use / warm-up)
+
+Usage:
+  python bench_startup.py [--runs 5] [--import-budget-ms 400] [--ready]
+
+With --import-budget-ms the script exits non-zero when the median import time
+exceeds the budget or when the import eagerly loads openai.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+PROBE = r"""
+import json, sys, time
+ready, ready_timeout = sys.argv[1] == "1", float(sys.argv[2])
+t0 = time.perf_counter()
+import endpoint
+t1 = time.perf_counter()
+out = {"openai_loaded": "openai" in sys.modules}
+client = endpoint.app.test_client()
+client.get("/health")
+t2 = time.perf_counter()
+r = client.post("/responses", json={"model": "default:stub", "input": "hi"})
+t3 = time.perf_counter()
+if r.status_code != 200:
+    sys.exit(f"/responses against the stub returned {r.status_code}: {r.get_data(as_text=True)}")
+out["import_ms"] = (t1 - t0) * 1000
+out["first_request_ms"] = (t2 - t1) * 1000
+out["first_chat_ms"] = (t3 - t2) * 1000
+if ready:
+    deadline = t3 + ready_timeout
+    while client.get("/ready").status_code != 200:
+        if time.perf_counter() > deadline:
+            break
+        time.sleep(0.01)
+    else:
+        out["ready_ms"] = (time.perf_counter() - t0) * 1000
+print(json.dumps(out))
+"""
+
+
+class _StubUpstream(BaseHTTPRequestHandler):
+    """Minimal OpenAI-compatible upstream: /models and non-streamed /chat/completions."""
+
+    def _send(self, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self._send({"object": "list", "data": [{"id": "stub", "object": "model",
+                                                "created": 0, "owned_by": "bench"}]})
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        self._send({
+            "id": "chatcmpl-bench", "object": "chat.completion", "created": int(time.time()),
+            "model": "stub",
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": "ok"}}],
+            "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+        })
+
+    def log_message(self, *args):
+        pass
+
+
+def start_stub():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _StubUpstream)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+
+def run_once(ready, ready_timeout, stub_url):
+    argv = [sys.executable, "-c", PROBE, "1" if ready else "0", str(ready_timeout)]
+    # The probe's chat call uses the inline "default:stub" route, so only the
+    # default provider has to point at the stub; other providers are untouched.
+    env = dict(os.environ, OPENAI_BASE_URL=stub_url, OPENAI_API_KEY="bench", OPENAI_MODEL="stub")
+    proc = subprocess.run(argv, cwd=HERE, env=env,
+                          capture_output=True, text=True, check=True)
+    # endpoint prints [DEBUG] lines; the result is the last line of stdout.
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("--runs", type=int, default=5)
+    ap.add_argument("--import-budget-ms", type=float, default=None)
+    ap.add_argument("--ready", action="store_true", help="also measure time until /ready is 200")
+    ap.add_argument("--ready-timeout", type=float, default=30.0)
+    args = ap.parse_args()
+
+    stub_url = start_stub()
+    results = [run_once(args.ready, args.ready_timeout, stub_url) for _ in range(args.runs)]
+
+    print(f"runs: {len(results)}")
+    for key in ("import_ms", "first_request_ms", "first_chat_ms", "ready_ms"):
+        vals = [r[key] for r in results if key in r]
+        if vals:
+            print(f"{key:>17}: median {statistics.median(vals):8.1f}  min {min(vals):8.1f}  max {max(vals):8.1f}")
+        elif key == "ready_ms" and args.ready:
+            print(f"{key:>17}: not ready within {args.ready_timeout}s")
+    eager = any(r["openai_loaded"] for r in results)
+    print(f"    openai_loaded: {eager}")
+
+    if args.import_budget_ms is not None:
+        median_import = statistics.median(r["import_ms"] for r in results)
+        if eager or median_import > args.import_budget_ms:
+            print(f"FAIL: import {median_import:.1f} ms (budget {args.import_budget_ms} ms), "
+                  f"openai_loaded={eager}", file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
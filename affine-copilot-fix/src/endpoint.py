@@ -27,6 +27,10 @@ Routing (all optional, backward compatible with the old single-provider setup):
 
   MODEL_ROUTES  (JSON)
       Map the model string AFFiNE sends -> {"provider":"gemini","model":"gemini-2.5-flash"}.
+      Keys are exact names, prefixes ("gpt-4o*"), globs ("gpt-5-*-mini") or
+      regexes ("re:^o[0-9]"). Exact beats the longest prefix, which beats
+      globs/regexes (first declared wins). An empty/missing "model" keeps the
+      incoming model string.
 
   Inline syntax (no table needed): set a scenario's model in AFFiNE to
       "provider:model"  e.g. "openrouter:anthropic/claude-3.5-sonnet"
@@ -36,16 +40,67 @@ Routing (all optional, backward compatible with the old single-provider setup):
   DEFAULT_MODEL      model used when the incoming model is unmapped (default: OPENAI_MODEL)
   PASSTHROUGH_MODEL  if true, unmapped requests keep AFFiNE's model string instead
                      of being rewritten to DEFAULT_MODEL (default: false)
+
+  ROUTING_CONFIG       path to a JSON file with any of the keys PROVIDERS,
+                       MODEL_ROUTES, MODEL_LIMITS, DEFAULT_PROVIDER, DEFAULT_MODEL,
+                       PASSTHROUGH_MODEL; its values override the env vars of the
+                       same name. The file is watched and reloaded on change:
+                       the new table is swapped in atomically, in-flight requests
+                       and streams finish on the one they started with, and
+                       cached clients whose (base_url, api_key) is unchanged are
+                       kept, so a route change opens no new connections.
+  ROUTING_CONFIG_POLL  seconds between checks of the file (default: 2)
+
+Context budget (optional):
+
+  Route entries may declare the target model's limits, and MODEL_LIMITS (JSON)
+  declares them per target model for the default / inline routes:
+        MODEL_ROUTES={"gpt-5-mini":{"provider":"gemini","model":"gemini-2.5-flash-lite",
+                                    "context_window":1048576,"max_output_tokens":65536}}
+        MODEL_LIMITS={"gemini-2.5-flash-lite":{"context_window":1048576,"max_output_tokens":65536}}
+  When a limit is known, max_tokens is clamped to max_output_tokens and the
+  messages are sized to fit before they leave the gateway (oversized documents
+  capped, middle history elided, system prompt and latest turns kept). The
+  number of estimated tokens removed is reported in X-Context-Trimmed-Tokens.
+
+Prompt caching:
+
+  AFFiNE resends the whole history (and often a large document as
+  `instructions`) every turn. Text is normalized and leading system messages
+  are merged into one canonical prefix, so upstreams see an identical prefix
+  turn after turn. A provider may also opt into prompt-cache hints via a
+  "prompt_cache" entry in PROVIDERS:
+        {"openrouter": {..., "prompt_cache": "cache_control"}}
+        {"openai":     {..., "prompt_cache": {"mode": "key", "min_chars": 2048}}}
+  "key" sends a stable `prompt_cache_key` derived from the prefix (OpenAI);
+  "cache_control" marks the prefix and the end of the history with
+  {"type": "ephemeral"} breakpoints (Anthropic / Gemini via OpenRouter).
+
+Startup / readiness:
+
+  The `openai` SDK (and the pydantic/httpx stack behind it) is imported lazily,
+  so the port is bound before any upstream client exists. A background warm-up
+  then builds one client per configured provider and probes `GET /models` to
+  validate it and open its connection pool. `/health` is plain liveness;
+  `/ready` returns 503 until every configured provider has passed warm-up.
+
+  WARMUP          run the warm-up on start (default: true; false = ready immediately)
+  WARMUP_TIMEOUT  per-probe timeout in seconds (default: 5)
+  WARMUP_RETRY    seconds between retries for providers that failed (default: 10)
 """
 
 from flask import Flask, request, jsonify, Response, stream_with_context
+import fnmatch
+import hashlib
 import json
 from datetime import datetime
 from dotenv import load_dotenv
 import os
+import re
+import sys
+import threading
 import time
 import uuid
-import openai
 
 load_dotenv()
 app = Flask(__name__)
@@ -68,46 +123,232 @@ def _load_json_env(name, default):
         return default
 
 
+def _float_env(name, default):
+    raw = os.getenv(name)
+    if not raw or not raw.strip():
+        return default
+    try:
+        return float(raw)
+    except ValueError:
+        print(f"[WARN] {name} is not a number ({raw!r}); using {default}.", flush=True)
+        return default
+
+
 CREATE_LOG = _as_bool(os.getenv("CREATE_LOG"))
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
 OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL", "")
 OPENAI_MODEL = os.getenv("OPENAI_MODEL", "")
 
-# ---- Provider + routing configuration -------------------------------------
-PROVIDERS = _load_json_env("PROVIDERS", {})
-# Always expose a "default" provider derived from the classic OPENAI_* envs so
-# the old single-backend configuration keeps working untouched.
-PROVIDERS.setdefault("default", {"base_url": OPENAI_BASE_URL, "api_key": OPENAI_API_KEY})
+ROUTING_CONFIG = os.getenv("ROUTING_CONFIG", "")
+ROUTING_CONFIG_POLL = _float_env("ROUTING_CONFIG_POLL", 2.0)
 
-MODEL_ROUTES = _load_json_env("MODEL_ROUTES", {})
-DEFAULT_PROVIDER = os.getenv("DEFAULT_PROVIDER", "default")
-DEFAULT_MODEL = os.getenv("DEFAULT_MODEL", OPENAI_MODEL)
-PASSTHROUGH_MODEL = _as_bool(os.getenv("PASSTHROUGH_MODEL"))
+WARMUP = _as_bool(os.getenv("WARMUP"), default=True)
+WARMUP_TIMEOUT = _float_env("WARMUP_TIMEOUT", 5.0)
+WARMUP_RETRY = _float_env("WARMUP_RETRY", 10.0)
 
 LOG_PATH = "logs"
 home_directory = os.path.dirname(__file__)
 log_directory = os.path.join(home_directory, LOG_PATH)
-os.makedirs(log_directory, exist_ok=True)
 
 # Cache OpenAI clients per (base_url, api_key) so we don't rebuild httpx pools.
+# Guarded by a lock because the warm-up thread fills it concurrently with requests.
 _CLIENT_CACHE = {}
+_CLIENT_LOCK = threading.Lock()
 
 
 def _debug(msg):
     print(f"[DEBUG] {datetime.now().isoformat()} - {msg}", flush=True)
 
 
-def _provider_cfg(name):
-    cfg = PROVIDERS.get(name)
-    if cfg is None:
-        cfg = PROVIDERS.get("default", {})
+# ---- Provider + routing configuration -------------------------------------
+
+_ROUTING_KEYS = ("PROVIDERS", "MODEL_ROUTES", "MODEL_LIMITS",
+                 "DEFAULT_PROVIDER", "DEFAULT_MODEL", "PASSTHROUGH_MODEL")
+_GLOB_CHARS = set("*?[")
+_PROMPT_CACHE_MODES = ("key", "cache_control")
+
+
+def _parse_prompt_cache(name, pc):
+    """Validate a provider's "prompt_cache" entry once -> (mode, min_chars) or None."""
+    if pc is None:
+        return None
+    if isinstance(pc, str):
+        # shorthand: "prompt_cache": "key"
+        mode, min_chars = pc, 0
+    elif isinstance(pc, dict):
+        mode, min_chars = pc.get("mode"), pc.get("min_chars") or 0
+    else:
+        mode, min_chars = None, 0
+    if mode not in _PROMPT_CACHE_MODES or isinstance(min_chars, bool) \
+            or not isinstance(min_chars, int) or min_chars < 0:
+        print(f"[WARN] PROVIDERS[{name!r}].prompt_cache is invalid ({pc!r}); ignoring.", flush=True)
+        return None
+    return mode, min_chars
+
+
+class RouteTable:
+    """
+    Immutable, compiled snapshot of the routing configuration.
+
+    MODEL_ROUTES keys are split once into an exact dict, a longest-first prefix
+    list and compiled glob/regex patterns; non-exact lookups are memoized on the
+    table. A reload builds a new table and swaps the module-level reference, so
+    a request that already holds a table keeps a consistent view of it.
+    """
+
+    _MEMO_SIZE = 1024
+
+    def __init__(self, cfg):
+        self.providers = dict(cfg.get("PROVIDERS") or {})
+        # Always expose a "default" provider derived from the classic OPENAI_* envs so
+        # the old single-backend configuration keeps working untouched.
+        self.providers.setdefault("default", {"base_url": OPENAI_BASE_URL, "api_key": OPENAI_API_KEY})
+        self.model_routes = cfg.get("MODEL_ROUTES") or {}
+        self.model_limits = cfg.get("MODEL_LIMITS") or {}
+        self.default_provider = cfg.get("DEFAULT_PROVIDER") or "default"
+        self.default_model = cfg.get("DEFAULT_MODEL") or ""
+        self.passthrough_model = _as_bool(cfg.get("PASSTHROUGH_MODEL"))
+        self.prompt_cache = {name: _parse_prompt_cache(name, pcfg.get("prompt_cache"))
+                             for name, pcfg in self.providers.items() if isinstance(pcfg, dict)}
+
+        self._exact = {}
+        self._prefixes = []
+        self._patterns = []
+        for key, route in self.model_routes.items():
+            try:
+                if key.startswith("re:"):
+                    self._patterns.append((re.compile(key[3:]), route))
+                elif key.endswith("*") and not _GLOB_CHARS & set(key[:-1]):
+                    self._prefixes.append((key[:-1], route))
+                elif _GLOB_CHARS & set(key):
+                    self._patterns.append((re.compile(fnmatch.translate(key)), route))
+                else:
+                    self._exact[key] = route
+            except re.error as e:
+                print(f"[WARN] MODEL_ROUTES key {key!r} is not a valid pattern ({e}); ignoring.", flush=True)
+        self._prefixes.sort(key=lambda kv: len(kv[0]), reverse=True)
+        self._memo = {}
+
+    def provider_cfg(self, name):
+        cfg = self.providers.get(name)
+        if cfg is None:
+            cfg = self.providers.get("default", {})
+        return cfg
+
+    def prompt_cache_for(self, name):
+        """Parsed prompt-cache hint of provider `name` (same fallback as provider_cfg)."""
+        if name not in self.providers:
+            name = "default"
+        return self.prompt_cache.get(name)
+
+    def lookup(self, model):
+        """Route entry for an incoming model string, or None."""
+        route = self._exact.get(model)
+        if route is not None or not (self._prefixes or self._patterns):
+            return route
+        try:
+            return self._memo[model]
+        except KeyError:
+            pass
+        for prefix, candidate in self._prefixes:
+            if model.startswith(prefix):
+                route = candidate
+                break
+        else:
+            for rx, candidate in self._patterns:
+                if rx.match(model):
+                    route = candidate
+                    break
+        if len(self._memo) < self._MEMO_SIZE:
+            self._memo[model] = route
+        return route
+
+    def exact_models(self):
+        return set(self._exact)
+
+
+def _routing_errors(cfg):
+    """Shape problems in a routing config (valid JSON is not enough for RouteTable)."""
+    errors = []
+    for key in ("PROVIDERS", "MODEL_ROUTES", "MODEL_LIMITS"):
+        value = cfg.get(key)
+        if value is None:
+            continue
+        if not isinstance(value, dict):
+            errors.append(f"{key} must be an object, got {type(value).__name__}")
+            continue
+        for name, entry in value.items():
+            allowed = (dict, str) if key == "MODEL_ROUTES" else (dict,)
+            if not isinstance(entry, allowed):
+                errors.append(f"{key}[{name!r}] must be "
+                              f"{'an object or string' if key == 'MODEL_ROUTES' else 'an object'}, "
+                              f"got {type(entry).__name__}")
+    for key in ("DEFAULT_PROVIDER", "DEFAULT_MODEL"):
+        value = cfg.get(key)
+        if value is not None and not isinstance(value, str):
+            errors.append(f"{key} must be a string, got {type(value).__name__}")
+    value = cfg.get("PASSTHROUGH_MODEL")
+    if value is not None and not isinstance(value, (str, bool)):
+        errors.append(f"PASSTHROUGH_MODEL must be a boolean or string, got {type(value).__name__}")
+    return errors
+
+
+def _routing_from_env():
+    cfg = {
+        "PROVIDERS": _load_json_env("PROVIDERS", {}),
+        "MODEL_ROUTES": _load_json_env("MODEL_ROUTES", {}),
+        "MODEL_LIMITS": _load_json_env("MODEL_LIMITS", {}),
+        "DEFAULT_PROVIDER": os.getenv("DEFAULT_PROVIDER", "default"),
+        "DEFAULT_MODEL": os.getenv("DEFAULT_MODEL", OPENAI_MODEL),
+        "PASSTHROUGH_MODEL": os.getenv("PASSTHROUGH_MODEL"),
+    }
+    # Same leniency as _load_json_env: a malformed env var is ignored, not fatal.
+    for key in ("PROVIDERS", "MODEL_ROUTES", "MODEL_LIMITS"):
+        errors = _routing_errors({key: cfg[key]})
+        if errors:
+            print(f"[WARN] {'; '.join(errors)}; ignoring {key}.", flush=True)
+            cfg[key] = {}
     return cfg
 
 
-def resolve_route(incoming_model, passthrough=None):
+def _config_stamp():
+    try:
+        st = os.stat(ROUTING_CONFIG)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+def _load_routing():
+    """Build a RouteTable from the env, overlaid with ROUTING_CONFIG. Raises on a bad file."""
+    cfg = _routing_from_env()
+    if ROUTING_CONFIG:
+        with open(ROUTING_CONFIG, "r", encoding="utf-8") as f:
+            file_cfg = json.load(f)
+        if not isinstance(file_cfg, dict):
+            raise ValueError("top level must be a JSON object")
+        errors = _routing_errors(file_cfg)
+        if errors:
+            raise ValueError("; ".join(errors))
+        cfg.update({k: file_cfg[k] for k in _ROUTING_KEYS if k in file_cfg})
+    return RouteTable(cfg)
+
+
+# Stamp taken before the read, so an edit racing startup still triggers a reload.
+_ROUTING_STAMP = _config_stamp() if ROUTING_CONFIG else None
+try:
+    _ROUTING = _load_routing()
+except Exception as e:
+    print(f"[WARN] ROUTING_CONFIG {ROUTING_CONFIG} could not be loaded ({e}); using env only.", flush=True)
+    _ROUTING = RouteTable(_routing_from_env())
+
+
+def resolve_route(incoming_model, passthrough=None, table=None):
     """
-    Map the model string AFFiNE sends to (provider_name, provider_cfg, target_model).
+    Map the model string AFFiNE sends to
+    (provider_name, provider_cfg, target_model, route), where `route` is the
+    MODEL_ROUTES entry that matched, or None for inline and default routing.
 
     Precedence: inline "provider:model" > MODEL_ROUTES table > default provider.
 
@@ -116,11 +357,16 @@ def resolve_route(incoming_model, passthrough=None):
     /embeddings and /images, where AFFiNE already sends a real target model);
     when False it is rewritten to DEFAULT_MODEL (correct for chat/responses,
     where AFFiNE sends models like "gpt-5-mini" the backend doesn't have).
-    None falls back to the global PASSTHROUGH_MODEL setting.
+    None falls back to the table's PASSTHROUGH_MODEL setting.
+
+    `table` defaults to the current RouteTable; pass one in to resolve several
+    things against the same snapshot.
     """
+    table = table or _ROUTING
     if passthrough is None:
-        passthrough = PASSTHROUGH_MODEL
+        passthrough = table.passthrough_model
     model = (incoming_model or "").strip()
+    default_provider = table.default_provider
 
     # 1) inline "provider:model" syntax
     if ":" in model:
@@ -129,36 +375,62 @@ def resolve_route(incoming_model, passthrough=None):
         rest = rest.strip()
         # only treat as routing if the prefix is a known provider (avoid eating
         # model ids that legitimately contain a colon)
-        if prov in PROVIDERS and rest:
-            return prov, _provider_cfg(prov), rest
+        if prov in table.providers and rest:
+            return prov, table.provider_cfg(prov), rest, None
 
     # 2) explicit routes table
-    route = MODEL_ROUTES.get(model)
+    route = table.lookup(model)
     if isinstance(route, dict):
-        prov = route.get("provider", DEFAULT_PROVIDER)
-        target = route.get("model") or model or DEFAULT_MODEL
-        return prov, _provider_cfg(prov), target
+        prov = route.get("provider", default_provider)
+        target = route.get("model") or model or table.default_model
+        return prov, table.provider_cfg(prov), target, route
     if isinstance(route, str) and route:
         # shorthand: "model_string": "just-the-target-model" on the default provider
-        return DEFAULT_PROVIDER, _provider_cfg(DEFAULT_PROVIDER), route
+        return default_provider, table.provider_cfg(default_provider), route, route
 
     # 3) default provider
     if passthrough and model:
         target = model
     else:
-        target = DEFAULT_MODEL or model
-    return DEFAULT_PROVIDER, _provider_cfg(DEFAULT_PROVIDER), target
+        target = table.default_model or model
+    return default_provider, table.provider_cfg(default_provider), target, None
 
 
-def get_client(provider_cfg):
+def route_limits(route, target_model, table=None):
+    """
+    Context/output limits for a routed request: MODEL_LIMITS[target_model],
+    overridden by "context_window" / "max_output_tokens" on `route`, the entry
+    resolve_route actually used (None for inline / default routing).
+    """
+    table = table or _ROUTING
+    limits = {}
+    base = table.model_limits.get(target_model)
+    if isinstance(base, dict):
+        limits.update(base)
+    if isinstance(route, dict):
+        limits.update({k: route[k] for k in ("context_window", "max_output_tokens") if k in route})
+    return {k: v for k, v in limits.items() if isinstance(v, int) and v > 0}
+
+
+def _client_key(provider_cfg):
     base_url = (provider_cfg or {}).get("base_url") or None
     api_key = (provider_cfg or {}).get("api_key") or OPENAI_API_KEY or "not-needed"
-    key = (base_url, api_key)
+    return base_url, api_key
+
+
+def get_client(provider_cfg):
+    key = _client_key(provider_cfg)
+    base_url, api_key = key
     client = _CLIENT_CACHE.get(key)
     if client is None:
-        client = openai.OpenAI(api_key=api_key, base_url=base_url) if base_url \
-            else openai.OpenAI(api_key=api_key)
-        _CLIENT_CACHE[key] = client
+        # Deferred: importing openai costs more than the rest of startup combined.
+        import openai
+        with _CLIENT_LOCK:
+            client = _CLIENT_CACHE.get(key)
+            if client is None:
+                client = openai.OpenAI(api_key=api_key, base_url=base_url) if base_url \
+                    else openai.OpenAI(api_key=api_key)
+                _CLIENT_CACHE[key] = client
     return client
 
 
@@ -182,6 +454,7 @@ def _log_request(data, tag, route_info=None):
     try:
         ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         fname = f"{tag}.log" if tag else "chat.log"
+        os.makedirs(log_directory, exist_ok=True)
         with open(os.path.join(log_directory, fname), "a", encoding="utf-8") as f:
             f.write(f"\n=== {ts} ===\n")
             if route_info:
@@ -194,6 +467,14 @@ def _log_request(data, tag, route_info=None):
 
 # ---- message conversion ---------------------------------------------------
 
+def _normalize_text(text):
+    # Line-ending / trailing-whitespace jitter is enough to break an upstream's
+    # prefix match, so text is normalized before it leaves the gateway.
+    if not isinstance(text, str):
+        return text
+    return text.replace("\r\n", "\n").rstrip()
+
+
 def _convert_content(content):
     """
     Normalize a single message's content into something the Chat Completions API
@@ -203,17 +484,17 @@ def _convert_content(content):
     if content is None:
         return ""
     if isinstance(content, str):
-        return content
+        return _normalize_text(content)
     if isinstance(content, list):
         parts = []
         for item in content:
             if not isinstance(item, dict):
                 if isinstance(item, str):
-                    parts.append({"type": "text", "text": item})
+                    parts.append({"type": "text", "text": _normalize_text(item)})
                 continue
             itype = item.get("type")
             if itype in ("text", "input_text", "output_text"):
-                parts.append({"type": "text", "text": item.get("text", "")})
+                parts.append({"type": "text", "text": _normalize_text(item.get("text") or "")})
             elif itype in ("image_url", "input_image"):
                 url = item.get("image_url") or item.get("url") or item.get("image")
                 if isinstance(url, dict):
@@ -221,9 +502,9 @@ def _convert_content(content):
                 elif isinstance(url, str):
                     parts.append({"type": "image_url", "image_url": {"url": url}})
             elif "text" in item and isinstance(item["text"], str):
-                parts.append({"type": "text", "text": item["text"]})
+                parts.append({"type": "text", "text": _normalize_text(item["text"])})
             elif "content" in item and isinstance(item["content"], str):
-                parts.append({"type": "text", "text": item["content"]})
+                parts.append({"type": "text", "text": _normalize_text(item["content"])})
         # collapse to a plain string when there's only text (widest compat)
         if parts and all(p.get("type") == "text" for p in parts):
             return "\n".join(p["text"] for p in parts)
@@ -239,6 +520,22 @@ def _role_map(role):
     return "user"
 
 
+def _canonical_prefix(messages):
+    """
+    Merge the leading run of system messages (`instructions` + any system /
+    developer input items) into a single one, so every turn of a conversation
+    starts with the byte-identical prefix upstream prompt caches key on.
+    """
+    n = 0
+    while n < len(messages) and messages[n]["role"] == "system":
+        n += 1
+    head = messages[:n]
+    if n < 2 or not all(isinstance(m["content"], str) for m in head):
+        return messages
+    merged = "\n\n".join(m["content"] for m in head if m["content"])
+    return [{"role": "system", "content": merged}] + messages[n:]
+
+
 def _convert_to_openai_messages(data):
     """
     Accept either OpenAI Chat Completions {"messages":[...]} or the Responses
@@ -248,7 +545,7 @@ def _convert_to_openai_messages(data):
 
     instructions = data.get("instructions")
     if isinstance(instructions, str) and instructions.strip():
-        messages.append({"role": "system", "content": instructions})
+        messages.append({"role": "system", "content": _normalize_text(instructions)})
 
     if "messages" in data and isinstance(data["messages"], list):
         for m in data["messages"]:
@@ -259,11 +556,11 @@ def _convert_to_openai_messages(data):
                 })
         if not messages:
             raise ValueError("No messages provided.")
-        return messages
+        return _canonical_prefix(messages)
 
     inp = data.get("input")
     if isinstance(inp, str):
-        messages.append({"role": "user", "content": inp})
+        messages.append({"role": "user", "content": _normalize_text(inp)})
         return messages
     if isinstance(inp, list):
         for item in inp:
@@ -275,13 +572,204 @@ def _convert_to_openai_messages(data):
             })
         if not messages:
             raise ValueError("No messages provided.")
-        return messages
+        return _canonical_prefix(messages)
 
     if messages:  # only had instructions
         return messages
     raise ValueError("No messages provided.")
 
 
+# ---- prompt-cache hints ---------------------------------------------------
+
+def _content_chars(content):
+    if isinstance(content, str):
+        return len(content)
+    return sum(len(p.get("text") or "") for p in content if isinstance(p, dict))
+
+
+def _with_cache_control(message):
+    """
+    Copy of `message` with an ephemeral cache breakpoint on its last non-empty
+    text part, or None if it has none (Anthropic rejects breakpoints on empty text).
+    """
+    content = message["content"]
+    if isinstance(content, str):
+        parts = [{"type": "text", "text": content}]
+    else:
+        parts = [dict(p) for p in content]
+    for p in reversed(parts):
+        if p.get("type") == "text" and p.get("text"):
+            p["cache_control"] = {"type": "ephemeral"}
+            break
+    else:
+        return None
+    return {"role": message["role"], "content": parts}
+
+
+def _apply_prompt_cache(params, hint):
+    """Attach a provider's prompt-cache hint (RouteTable.prompt_cache_for) to the upstream params."""
+    if not hint:
+        return
+    mode, min_chars = hint
+    messages = params["messages"]
+    if sum(_content_chars(m["content"]) for m in messages) < min_chars:
+        return
+
+    if mode == "key":
+        extra = params.setdefault("extra_body", {})
+        if "prompt_cache_key" in extra:
+            return
+        # Same model + same system prefix -> same key, so one AFFiNE document /
+        # chat keeps landing on the upstream cache that already holds it. Without
+        # a system prefix the first turn identifies the conversation instead;
+        # keying on the model alone would pile every chat onto one key.
+        head = messages[:1]
+        raw = json.dumps([params.get("model"), head], sort_keys=True, ensure_ascii=False)
+        extra["prompt_cache_key"] = "affine-" + hashlib.blake2b(raw.encode("utf-8"), digest_size=16).hexdigest()
+    elif mode == "cache_control":
+        # Breakpoints after the system prefix and after the history preceding
+        # the newest turn: both are resent verbatim on the next request. A mark
+        # that lands on a message without text moves back to the nearest one with text.
+        out = list(messages)
+        starts = ([0] if messages[0]["role"] == "system" else []) + \
+                 ([len(messages) - 2] if len(messages) >= 2 else [])
+        for start in starts:
+            for i in range(start, -1, -1):
+                marked = _with_cache_control(messages[i])
+                if marked is not None:
+                    out[i] = marked
+                    break
+        params["messages"] = out
+
+
+# ---- context budget -------------------------------------------------------
+
+_MESSAGE_OVERHEAD = 4     # role + framing tokens per chat message
+_IMAGE_TOKENS = 765       # a high-detail image under OpenAI's tile accounting
+_ESTIMATE_SLACK = 0.9     # the estimator is approximate; keep 10% headroom
+_TRIM_MARKER = "\n\n[... truncated by the gateway to fit the model's context window ...]"
+
+
+def _estimate_text(text):
+    # ~4 UTF-8 bytes per token holds for English, markdown and code; CJK text
+    # (3 bytes/char) comes out somewhat low, which _ESTIMATE_SLACK absorbs.
+    if not isinstance(text, str):
+        return 0
+    n = len(text) if text.isascii() else len(text.encode("utf-8"))
+    return (n + 3) // 4
+
+
+def _estimate_message(message):
+    content = message["content"]
+    if isinstance(content, str):
+        return _MESSAGE_OVERHEAD + _estimate_text(content)
+    n = _MESSAGE_OVERHEAD
+    for p in content:
+        n += _estimate_text(p.get("text", "")) if p.get("type") == "text" else _IMAGE_TOKENS
+    return n
+
+
+def _truncate_text(text, max_tokens):
+    est = _estimate_text(text)
+    if est <= max_tokens:
+        return text
+    keep = max(max_tokens - _estimate_text(_TRIM_MARKER), 0)
+    return text[:len(text) * keep // est] + _TRIM_MARKER
+
+
+def _cap_message(message, max_tokens):
+    """Copy of `message` with its text cut down to roughly `max_tokens` (images kept)."""
+    content = message["content"]
+    budget = max_tokens - _MESSAGE_OVERHEAD
+    if isinstance(content, str):
+        return {"role": message["role"], "content": _truncate_text(content, budget)}
+    texts = [p for p in content if p.get("type") == "text"]
+    budget -= _IMAGE_TOKENS * (len(content) - len(texts))
+    text_tokens = sum(_estimate_text(p.get("text", "")) for p in texts)
+    if text_tokens <= budget or text_tokens == 0:
+        # nothing to cut (or only images, which are never dropped)
+        return message
+    parts = []
+    for p in content:
+        if p.get("type") == "text":
+            share = _estimate_text(p.get("text", "")) * max(budget, 0) // text_tokens
+            p = dict(p, text=_truncate_text(p.get("text", ""), share))
+        parts.append(p)
+    return {"role": message["role"], "content": parts}
+
+
+def _fit_context(params, limits):
+    """
+    Clamp max_tokens and size params["messages"] to the model's context window.
+    Returns the estimated number of tokens removed, or None when no limit is known.
+
+    Policy, applied only as far as needed:
+      1. cap any single message other than the newest turn (typically a pasted
+         document / instructions) to half of the input budget,
+      2. drop the oldest history between the system prefix and the newest turn,
+      3. cap the largest remaining message to whatever is left.
+    """
+    ctx = limits.get("context_window")
+    max_out = limits.get("max_output_tokens")
+    # max_tokens comes straight from the client; anything but a real int is left
+    # for the upstream to reject with a proper 400.
+    requested = params.get("max_tokens")
+    if isinstance(requested, bool) or not isinstance(requested, int) or requested <= 0:
+        requested = None
+    if max_out and requested and requested > max_out:
+        params["max_tokens"] = requested = max_out
+    if not ctx:
+        return None
+
+    # Reserve what the client asked for; otherwise a typical answer rather than the
+    # model's full output limit. Never more than half the window, so an oversized
+    # max_tokens can't leave the prompt with no budget at all.
+    reserve = requested or min(max_out or 4096, 4096)
+    reserve = min(reserve, ctx // 2)
+    budget = int((ctx - reserve) * _ESTIMATE_SLACK)
+    messages = list(params["messages"])
+    sizes = [_estimate_message(m) for m in messages]
+    before = total = sum(sizes)
+    if total <= budget:
+        return 0
+
+    # 1) oversized documents
+    cap = budget // 2
+    for i in range(len(messages) - 1):
+        if sizes[i] > cap:
+            messages[i] = _cap_message(messages[i], cap)
+            new_size = _estimate_message(messages[i])
+            total -= sizes[i] - new_size
+            sizes[i] = new_size
+
+    # 2) elide middle history, oldest first, keeping the system prefix + newest turn
+    head = 0
+    while head < len(messages) - 1 and messages[head]["role"] == "system":
+        head += 1
+    while total > budget and len(messages) - head > 1:
+        total -= sizes.pop(head)
+        messages.pop(head)
+
+    # 3) still too big (huge system prompt or newest turn): cap the largest one
+    if total > budget:
+        i = max(range(len(messages)), key=sizes.__getitem__)
+        messages[i] = _cap_message(messages[i], sizes[i] - (total - budget))
+        new_size = _estimate_message(messages[i])
+        total -= sizes[i] - new_size
+        sizes[i] = new_size
+
+    params["messages"] = messages
+    removed = max(before - total, 0)
+    _debug(f"[context] ~{before} -> ~{total} tokens (window {ctx}, reserve {reserve})")
+    return removed
+
+
+def _with_trim_header(resp, trimmed):
+    if trimmed is not None:
+        resp.headers["X-Context-Trimmed-Tokens"] = str(trimmed)
+    return resp
+
+
 def _build_upstream_params(data):
     params = {}
     for k in PASSTHRU_KEYS:
@@ -295,6 +783,10 @@ def _build_upstream_params(data):
 
 def _map_error(e, tag):
     _debug(f"[{tag}] {type(e).__name__}: {e}")
+    # An openai error can only exist once the SDK has been imported.
+    openai = sys.modules.get("openai")
+    if openai is None:
+        return _err_payload(f"Unexpected error: {e}", status=500)
     if isinstance(e, openai.RateLimitError):
         return _err_payload(f"Rate limit exceeded: {e}", type_="rate_limit_error", status=429)
     if isinstance(e, openai.AuthenticationError):
@@ -325,7 +817,8 @@ def chat_completions():
         return _err_payload(str(e), type_="invalid_request_error", status=400)
 
     stream = bool(data.get("stream", False))
-    prov_name, prov_cfg, model = resolve_route(data.get("model"))
+    table = _ROUTING
+    prov_name, prov_cfg, model, route = resolve_route(data.get("model"), table=table)
     if not model:
         return _err_payload("No target model resolved (set OPENAI_MODEL/DEFAULT_MODEL or a route).",
                             type_="invalid_request_error", status=400)
@@ -337,6 +830,8 @@ def chat_completions():
     params = _build_upstream_params(data)
     params["model"] = model
     params["messages"] = messages
+    trimmed = _fit_context(params, route_limits(route, model, table=table))
+    _apply_prompt_cache(params, table.prompt_cache_for(prov_name))
 
     try:
         client = get_client(prov_cfg)
@@ -380,7 +875,7 @@ def chat_completions():
             resp = Response(stream_with_context(gen()), mimetype="text/event-stream")
             resp.headers["Cache-Control"] = "no-cache, no-transform"
             resp.headers["X-Accel-Buffering"] = "no"
-            return resp
+            return _with_trim_header(resp, trimmed)
 
         resp = client.chat.completions.create(**params)
         out = {
@@ -401,7 +896,7 @@ def chat_completions():
             out["usage"] = resp.usage.model_dump() if getattr(resp, "usage", None) else None
         except Exception:
             pass
-        return jsonify(out)
+        return _with_trim_header(jsonify(out), trimmed)
 
     except Exception as e:
         return _map_error(e, "chat")
@@ -527,7 +1022,8 @@ def responses_route():
         return _err_payload(str(e), type_="invalid_request_error", status=400)
 
     stream = bool(data.get("stream", False))
-    prov_name, prov_cfg, model = resolve_route(data.get("model"))
+    table = _ROUTING
+    prov_name, prov_cfg, model, route = resolve_route(data.get("model"), table=table)
     if not model:
         return _err_payload("No target model resolved (set OPENAI_MODEL/DEFAULT_MODEL or a route).",
                             type_="invalid_request_error", status=400)
@@ -539,6 +1035,8 @@ def responses_route():
     params = _build_upstream_params(data)
     params["model"] = model
     params["messages"] = messages
+    trimmed = _fit_context(params, route_limits(route, model, table=table))
+    _apply_prompt_cache(params, table.prompt_cache_for(prov_name))
 
     try:
         client = get_client(prov_cfg)
@@ -558,7 +1056,7 @@ def responses_route():
             resp = Response(stream_with_context(gen()), mimetype="text/event-stream")
             resp.headers["Cache-Control"] = "no-cache, no-transform"
             resp.headers["X-Accel-Buffering"] = "no"
-            return resp
+            return _with_trim_header(resp, trimmed)
 
         resp = client.chat.completions.create(**params)
         text = "".join((c.message.content or "") for c in resp.choices if c.message)
@@ -570,7 +1068,7 @@ def responses_route():
         payload = _base_response_obj(f"resp_{uuid.uuid4().hex}", resp.model or model,
                                      "completed", output=[item],
                                      usage=_usage_to_responses(getattr(resp, "usage", None)))
-        return jsonify(payload)
+        return _with_trim_header(jsonify(payload), trimmed)
 
     except Exception as e:
         return _map_error(e, "responses")
@@ -591,7 +1089,7 @@ def embeddings_route():
         return _err_payload("No 'input' provided.", type_="invalid_request_error", status=400)
 
     # Embeddings: AFFiNE already sends a real embedding model id -> keep it.
-    prov_name, prov_cfg, model = resolve_route(data.get("model"), passthrough=True)
+    prov_name, prov_cfg, model, _ = resolve_route(data.get("model"), passthrough=True)
     route_info = f"{prov_name} -> {model} (from '{data.get('model')}')"
     _log_request(data, tag="embeddings", route_info=route_info)
     _debug(f"[embeddings] {route_info}")
@@ -627,7 +1125,7 @@ def images_route():
         return _err_payload("No 'prompt' provided.", type_="invalid_request_error", status=400)
 
     # Images: AFFiNE already sends a real image model id -> keep it.
-    prov_name, prov_cfg, model = resolve_route(data.get("model"), passthrough=True)
+    prov_name, prov_cfg, model, _ = resolve_route(data.get("model"), passthrough=True)
     route_info = f"{prov_name} -> {model} (from '{data.get('model')}')"
     _log_request(data, tag="images", route_info=route_info)
     _debug(f"[images] {route_info}")
@@ -649,25 +1147,180 @@ def images_route():
 
 
 # ===========================================================================
-# Misc: health + model listing (some clients probe /models)
+# Warm-up + readiness
+# ===========================================================================
+_STARTED_AT = time.monotonic()
+_READY_LOCK = threading.Lock()
+_READY = {"started": False, "ready": not WARMUP, "warmup_ms": None, "providers": {}}
+
+
+def _configured_providers(table=None):
+    """Providers that have something to validate (skip an unset implicit default)."""
+    return {name: cfg for name, cfg in (table or _ROUTING).providers.items()
+            if isinstance(cfg, dict) and (cfg.get("base_url") or cfg.get("api_key"))}
+
+
+def _probe_provider(cfg):
+    """
+    Validate a provider and open its connection pool with one `GET /models`.
+    `with_options` shares the cached client's httpx pool, so the connection made
+    here is the one the first real request reuses.
+    """
+    import openai
+    client = get_client(cfg).with_options(timeout=WARMUP_TIMEOUT, max_retries=0)
+    try:
+        client.models.list()
+    except openai.APIStatusError as e:
+        # Any HTTP answer proves the upstream is reachable (some backends don't
+        # implement /models); only a rejected key counts as a failed validation.
+        if e.status_code in (401, 403):
+            raise
+
+
+def _warmup(pending, mark_ready=True):
+    _debug(f"[warmup] probing {sorted(pending)}")
+    while True:
+        # Stop retrying providers a routing reload has since removed or changed.
+        providers = _ROUTING.providers
+        pending = {name: cfg for name, cfg in pending.items() if providers.get(name) == cfg}
+        for name, cfg in list(pending.items()):
+            t0 = time.monotonic()
+            try:
+                _probe_provider(cfg)
+            except Exception as e:
+                state = {"ok": False, "error": f"{type(e).__name__}: {e}"}
+                _debug(f"[warmup] {name} failed: {state['error']}")
+            else:
+                state = {"ok": True, "ms": round((time.monotonic() - t0) * 1000, 1)}
+                del pending[name]
+            with _READY_LOCK:
+                _READY["providers"][name] = state
+        if not pending:
+            break
+        time.sleep(WARMUP_RETRY)
+
+    if not mark_ready:
+        return
+    with _READY_LOCK:
+        _READY["ready"] = True
+        _READY["warmup_ms"] = round((time.monotonic() - _STARTED_AT) * 1000, 1)
+    _debug(f"[warmup] ready after {_READY['warmup_ms']} ms")
+
+
+def _start_warmup():
+    """Start the background warm-up once (idempotent, no-op when WARMUP is off)."""
+    with _READY_LOCK:
+        if _READY["started"] or not WARMUP:
+            return
+        _READY["started"] = True
+    threading.Thread(target=_warmup, args=(_configured_providers(),),
+                     name="warmup", daemon=True).start()
+
+
+# ===========================================================================
+# Routing config hot reload
+# ===========================================================================
+_WATCHER_STARTED = False
+
+
+def reload_routing():
+    """
+    Rebuild the RouteTable from env + ROUTING_CONFIG and swap it in atomically.
+
+    Cached clients whose (base_url, api_key) is still used by some provider are
+    kept, pool and all. The rest are only dropped from the cache, not closed,
+    since in-flight streams may still be reading from them. Providers with a new
+    (base_url, api_key) are warmed in the background. Raises, leaving the
+    current table in place, if the file can't be read or parsed.
+    """
+    global _ROUTING
+    table = _load_routing()
+    live = {_client_key(cfg) for cfg in table.providers.values() if isinstance(cfg, dict)}
+    with _CLIENT_LOCK:
+        known = set(_CLIENT_CACHE)
+        _ROUTING = table
+        for key in known - live:
+            del _CLIENT_CACHE[key]
+    with _READY_LOCK:
+        for name in set(_READY["providers"]) - set(table.providers):
+            del _READY["providers"][name]
+
+    fresh = {name: cfg for name, cfg in _configured_providers(table).items()
+             if _client_key(cfg) not in known}
+    if fresh and WARMUP:
+        threading.Thread(target=_warmup, args=(fresh, False),
+                         name="warmup-reload", daemon=True).start()
+    _debug(f"[routing] reloaded: {len(table.model_routes)} route(s), "
+           f"providers {sorted(table.providers)}, kept {len(known & live)} client(s), "
+           f"new {sorted(fresh)}")
+    return table
+
+
+def _watch_routing(stamp):
+    while True:
+        time.sleep(ROUTING_CONFIG_POLL)
+        current = _config_stamp()
+        # unchanged, or missing mid-replace (editors / k8s ConfigMap symlink swaps)
+        if current is None or current == stamp:
+            continue
+        stamp = current
+        try:
+            reload_routing()
+        except Exception as e:
+            # Never let a bad edit kill the watcher: later fixes must still apply.
+            print(f"[WARN] ROUTING_CONFIG reload failed ({type(e).__name__}: {e}); "
+                  f"keeping the current routes.", flush=True)
+
+
+def _start_config_watcher():
+    """Start polling ROUTING_CONFIG for changes once (no-op when it isn't set)."""
+    global _WATCHER_STARTED
+    with _READY_LOCK:
+        if _WATCHER_STARTED or not ROUTING_CONFIG:
+            return
+        _WATCHER_STARTED = True
+    threading.Thread(target=_watch_routing, args=(_ROUTING_STAMP,),
+                     name="routing-watch", daemon=True).start()
+
+
+# ===========================================================================
+# Misc: health, readiness + model listing (some clients probe /models)
 # ===========================================================================
 @app.route("/", methods=["GET"])
 @app.route("/health", methods=["GET"])
 def health():
-    return jsonify({"status": "ok", "providers": sorted(PROVIDERS.keys())})
+    return jsonify({"status": "ok", "providers": sorted(_ROUTING.providers.keys())})
+
+
+@app.route("/ready", methods=["GET"])
+def ready():
+    # Also kick off background work when served by a WSGI server that never runs __main__.
+    _start_warmup()
+    _start_config_watcher()
+    with _READY_LOCK:
+        is_ready = _READY["ready"]
+        body = {"status": "ready" if is_ready else "starting",
+                "warmup_ms": _READY["warmup_ms"],
+                "providers": dict(_READY["providers"])}
+    return jsonify(body), 200 if is_ready else 503
 
 
 @app.route("/models", methods=["GET"])
 @app.route("/v1/models", methods=["GET"])
 def models():
-    ids = set(MODEL_ROUTES.keys())
-    if DEFAULT_MODEL:
-        ids.add(DEFAULT_MODEL)
+    table = _ROUTING
+    ids = table.exact_models()
+    if table.default_model:
+        ids.add(table.default_model)
     data = [{"id": m, "object": "model", "created": int(time.time()), "owned_by": "affine-copilot-fix"}
             for m in sorted(ids)]
     return jsonify({"object": "list", "data": data})
 
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=int(os.getenv("PORT", "5000")),
-            debug=_as_bool(os.getenv("DEBUG", "true")))
+    debug = _as_bool(os.getenv("DEBUG", "true"))
+    # With the debug reloader only the serving child (WERKZEUG_RUN_MAIN) warms up.
+    if not debug or os.getenv("WERKZEUG_RUN_MAIN") == "true":
+        _start_warmup()
+        _start_config_watcher()
+    app.run(host="0.0.0.0", port=int(os.getenv("PORT", "5000")), debug=debug)